@@ -409,7 +409,7 @@ class FileTreeDatasetBase(TransformDataset):
         ret = []
         for data_key in self.data_keys:
             if self.use_cache and item in self._cache[data_key]:
-                ret.append(self._cache[data_key][item])
+                val = self._cache[data_key][item]
             else:
                 if data_key in self.trial_info.keys():
                     val = self.trial_info[data_key][item : item + 1]
@@ -417,8 +417,11 @@ class FileTreeDatasetBase(TransformDataset):
                     datapath = self.resolve_data_path(data_key)
                     val = np.load(datapath / "{}.npy".format(item))
                 if self.use_cache:
+                    # cached data is read-only, so that it cannot be changed through returned items
+                    # (ToTensor copies read-only arrays instead of sharing their memory)
+                    val.setflags(write=False)
                     self._cache[data_key][item] = val
-                ret.append(val)
+            ret.append(val)
 
         # create data point and transform
         x = self.data_point(*ret)
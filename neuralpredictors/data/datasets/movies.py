@@ -1,8 +1,9 @@
+import os
 from collections import namedtuple
+from functools import lru_cache, partial
 
-import h5py
 import numpy as np
-from scipy.signal import convolve2d
+import torch
 from torch.utils.data import Dataset
 
 from ..transforms import DataTransform, Delay, MovieTransform, Subsequence
@@ -15,75 +16,328 @@ from .base import (
 )
 
 
+def _filled(shape, value):
+    """
+    Returns a float32 array of shape `shape` with `value` broadcast into it. The array is written only
+    once (no ones * value), and is writable and contiguous, so that ToTensor can wrap it without a copy.
+    """
+    filled = np.empty(shape, dtype=np.float32)
+    filled[...] = value
+    return filled
+
+
+def _tile_mean(mean, *shape):
+    """
+    Returns a float32 array of shape `shape + mean.shape` holding `mean` for every entry of `shape`.
+    """
+    mean = np.asarray(mean, dtype=np.float32)
+    return _filled(shape + mean.shape, mean)
+
+
+class _StatisticsCacheMixin:
+    """
+    Mixin for datasets with `statistics`, which reads each statistic only once and then serves it from memory.
+    """
+
+    def _statistic(self, data_key, stats_source, what):
+        """
+        Returns the statistic `what` (e.g. "mean") of `data_key` over `stats_source` from `self.statistics`.
+        """
+        # the cache is created on first use and accessed through __dict__, so that it bypasses __getattr__
+        cache = self.__dict__.setdefault("_statistics_cache", {})
+        key = (data_key, stats_source, what)
+        if key not in cache:
+            value = self.statistics[data_key][stats_source][what][()]
+            if isinstance(value, np.ndarray):
+                # read-only, so that the statistic cannot be changed through returned values
+                # (ToTensor copies read-only arrays instead of sharing their memory)
+                value.setflags(write=False)
+            cache[key] = value
+        return cache[key]
+
+
+@lru_cache(maxsize=None)
+def _point_class(name, fields):
+    """
+    Creates a namedtuple class `name` with `fields`. Unlike plain namedtuples created at runtime, instances can
+    be pickled (e.g. when sent from DataLoader workers), and all their tensors can be moved to pinned memory
+    or to a device at once. Classes are cached, so that the same `name` and `fields` always give the same class.
+    """
+
+    class Point(namedtuple(name, fields)):
+        __slots__ = ()
+
+        def __reduce__(self):
+            return _make_point, (name, fields, tuple(self))
+
+        def pin_memory(self):
+            return self._make(
+                torch.as_tensor(v).pin_memory() if isinstance(v, (torch.Tensor, np.ndarray)) else v for v in self
+            )
+
+        def to(self, device, non_blocking=False):
+            return self._make(
+                v.to(device, non_blocking=non_blocking) if isinstance(v, torch.Tensor) else v for v in self
+            )
+
+    Point.__name__ = Point.__qualname__ = name
+    return Point
+
+
+def _make_point(name, fields, values):
+    return _point_class(name, fields)(*values)
+
+
 class H5SequenceSet(TransformDataset):
-    def __init__(self, filename, *data_keys, output_rename=None, transforms=None, output_dict=False):
+    def __init__(
+        self,
+        filename,
+        *data_keys,
+        output_rename=None,
+        transforms=None,
+        output_dict=False,
+        prefetch=0,
+        eager_keys=("responses", "behavior", "eye_position"),
+        swmr=False,
+    ):
+        """
+        Dataset for sequence (e.g. movie) data stored in hdf5 files. Each data key is either a group holding
+        one dataset per trial ("0", "1", ...), or a single dataset with the trials stacked along the first axis
+        (see convert_movies_h5_dataset_to_stacked in neuralpredictors.data.utils).
+        Args:
+            filename:       filename of the hdf5 file
+            *data_keys:     data keys to be read from the file
+            output_rename:  dictionary mapping data keys to the names used in the returned data points
+            transforms:     list of transforms applied to each datapoint
+            output_dict:    return data points as dictionaries instead of namedtuples
+            prefetch:       number of trials read at once from stacked data keys. Defaults to 0, reading single trials
+            eager_keys:     data keys that are read into memory at construction instead of on access
+            swmr:           open the file in single-writer-multiple-reader mode, e.g. to read while it is written
+        """
         super().__init__(transforms=transforms)
 
-        self.output_dict = output_dict
-
         if output_rename is None:
             output_rename = {}
 
-        # a flag that can be changed to turn renaming on/off
-        self.rename_output = True
-
         self.output_rename = output_rename
 
-        self._fid = h5py.File(filename, "r")
-        self.data = self._fid
+        self.filename = filename
+        self.swmr = swmr
+        self.data_keys = data_keys
         self.data_loaded = False
 
+        # number of trials read at once from datasets that are stored stacked along the first axis
+        self.prefetch = prefetch
+        self._eager = {}
+        self._open()
+
         # ensure that all elements of data_keys exist
         m = None
         for key in data_keys:
-            assert key in self.data, "Could not find {} in file".format(key)
-            l = len(self.data[key])
+            l = len(self._dsets[key])
             if m is not None and l != m:
                 raise ValueError("groups have different length")
             m = l
         self._len = m
+        # the eager groups are held in memory from the start, so that only the others (e.g. inputs) are read from file
+        self._eager = {g: self._load_eager(self._dsets[g]) for g in data_keys if g in eager_keys}
+        self._build_readers()
 
         # Specify which types of transforms are accepted
         self._transform_set = DataTransform
 
-        self.data_keys = data_keys
         self.transforms = transforms or []
 
-        self.data_point = namedtuple("DataPoint", data_keys)
-        renamed_keys = [output_rename.get(k, k) for k in data_keys]
-        self.output_point = namedtuple("OutputPoint", renamed_keys)
+        self._build_points()
+
+        # flags that can be changed to turn renaming and dictionary output on/off
+        self._output_dict = output_dict
+        self.rename_output = True
+
+    def _build_points(self):
+        self.data_point = _point_class("DataPoint", self.data_keys)
+        renamed_keys = tuple(self.output_rename.get(k, k) for k in self.data_keys)
+        self.output_point = _point_class("OutputPoint", renamed_keys)
+
+    @property
+    def rename_output(self):
+        return self._rename_output
+
+    @rename_output.setter
+    def rename_output(self, value):
+        self._rename_output = value
+        self._build_output()
+
+    @property
+    def output_dict(self):
+        return self._output_dict
+
+    @output_dict.setter
+    def output_dict(self, value):
+        self._output_dict = value
+        self._build_output()
+
+    def _build_output(self):
+        # fuse renaming and dictionary conversion into one step once instead of branching for every item
+        renamed_keys = self.output_point._fields
+        if self._rename_output and self._output_dict:
+            self._make_output = lambda x: dict(zip(renamed_keys, x))
+        elif self._output_dict:
+            self._make_output = lambda x: x._asdict()
+        elif self._rename_output:
+            self._make_output = self.output_point._make
+        else:
+            self._make_output = lambda x: x
+
+    def _open(self):
+        import h5py
+
+        # enlarge the chunk cache so that chunked datasets are not re-read for neighbouring trials
+        self._fid = h5py.File(self.filename, "r", swmr=self.swmr, rdcc_nbytes=64 << 20)
+        self._pid = os.getpid()
+        for key in self.data_keys:
+            assert key in self._fid, "Could not find {} in file".format(key)
+        # resolve the groups once instead of walking the file for every item
+        self._dsets = {g: self._fid[g] for g in self.data_keys}
+        self._blocks = {}
+        if not self.data_loaded:
+            self.data = self._fid
+        self._build_readers()
+
+    def _ensure_fid(self):
+        """
+        Reopens the file if it was opened in another process. HDF5 handles do not survive being forked
+        into DataLoader workers, so each worker reads through its own handle (and chunk cache).
+        """
+        if self._pid != os.getpid():
+            self._open()
+
+    def __getstate__(self):
+        # the file handle, everything resolved from it, and the classes and functions built at runtime cannot
+        # be pickled (e.g. for DataLoader workers that are spawned). They are rebuilt after unpickling, and the
+        # file is reopened on first use.
+        state = self.__dict__.copy()
+        for attr in ("_fid", "_dsets", "_readers", "_blocks", "data_point", "output_point", "_make_output"):
+            state.pop(attr, None)
+        if not self.data_loaded:
+            state.pop("data", None)
+        state["_pid"] = None
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._build_points()
+        self._build_output()
 
     def __dir__(self):
+        self._ensure_fid()
         attrs = set(super().__dir__())
         return attrs.union(set(self._fid.keys()))
 
     def load_content(self):
         self.data = recursively_load_dict_contents_from_group(self._fid)
         self.data_loaded = True
+        self._build_readers()
 
     def unload_content(self):
         self.data = self._fid
         self.data_loaded = False
+        self._build_readers()
 
     def __len__(self):
         return self._len
 
+    @staticmethod
+    def _load_eager(dset):
+        """
+        Reads all trials of `dset` into one flat buffer. Returns the buffer together with
+        the offsets and shapes of the trials within it, so that each trial is a view into the buffer.
+        """
+        import h5py
+
+        if not isinstance(dset, h5py.Group):
+            # stacked trials already come as one contiguous array
+            shapes = [dset.shape[1:]] * len(dset)
+            offsets = np.arange(len(dset) + 1) * int(np.prod(dset.shape[1:]))
+            return dset[()].reshape(-1), offsets, shapes
+
+        trials = [dset[str(i)] for i in range(len(dset))]
+        shapes = [trial.shape for trial in trials]
+        offsets = np.cumsum([0] + [trial.size for trial in trials])
+        # fill the buffer trial by trial, so that the data is not held twice while it is read
+        buffer = np.empty(offsets[-1], dtype=np.result_type(*[trial.dtype for trial in trials]) if trials else None)
+        for trial, start, stop in zip(trials, offsets[:-1], offsets[1:]):
+            buffer[start:stop] = trial[()].ravel()
+        return buffer, offsets, shapes
+
+    def _build_readers(self):
+        """
+        Resolves once for every data key how its trials are read (from memory, from a group of trials, or
+        from a stacked dataset), so that __getitem__ does not have to decide this for every item.
+        """
+        import h5py
+
+        readers = []
+        for g in self.data_keys:
+            if g in self._eager:
+                readers.append(partial(self._read_eager, *self._eager[g]))
+            elif self.data_loaded:
+                readers.append(partial(self._read_loaded, self.data[g]))
+            elif isinstance(self._dsets[g], h5py.Group):
+                readers.append(partial(self._read_group, self._dsets[g]))
+            else:
+                readers.append(partial(self._read_stacked, g))
+        self._readers = readers
+
+    # data held in memory is handed out as copies, so that changing a returned item does not change the dataset
+    @staticmethod
+    def _read_eager(buffer, offsets, shapes, item, key):
+        return buffer[offsets[item] : offsets[item + 1]].reshape(shapes[item]).copy()
+
+    @staticmethod
+    def _read_loaded(group, item, key):
+        return np.array(group[key])
+
+    @staticmethod
+    def _read_group(group, item, key):
+        return np.asarray(group[key])
+
+    def _read_stacked(self, data_key, item, key):
+        # trials are stacked along the first axis of a single dataset
+        dset = self._dsets[data_key]
+        if not self.prefetch:
+            return dset[item]
+        start, block = self._blocks.get(data_key, (None, None))
+        if start is None or not start <= item < start + len(block):
+            start = item - item % self.prefetch
+            block = dset[start : start + self.prefetch]
+            self._blocks[data_key] = (start, block)
+        return block[item - start].copy()
+
     def __getitem__(self, item):
-        x = self.data_point(*(np.array(self.data[g][item if self.data_loaded else str(item)]) for g in self.data_keys))
+        self._ensure_fid()
+        # key of the item within a group of trials, resolved once for all data keys
+        key = item if self.data_loaded else str(item)
+        x = self.data_point(*[read(item, key) for read in self._readers])
         for tr in self.transforms:
             assert isinstance(tr, self._transform_set)
             x = tr(x)
 
         # convert to output point
-        if self.rename_output:
-            x = self.output_point(*x)
-
-        if self.output_dict:
-            x = x._asdict()
-        return x
+        return self._make_output(x)
 
     def __getattr__(self, item):
+        if "_pid" not in self.__dict__:
+            # not initialized (yet), e.g. while unpickling
+            raise AttributeError("Item {} not found in {}".format(item, self.__class__.__name__))
+        if self._pid != os.getpid():
+            # attributes resolved from the file (e.g. data) are only set once the file is reopened
+            self._open()
+            if item in self.__dict__:
+                return self.__dict__[item]
         if item in self.data:
+            import h5py
+
             item = self.data[item]
             if isinstance(item, h5py.Dataset):
                 dtype = item.dtype
@@ -104,14 +358,15 @@ class H5SequenceSet(TransformDataset):
         return s
 
 
-class MovieSet(H5SequenceSet):
+class MovieSet(_StatisticsCacheMixin, H5SequenceSet):
     """
     Extension to H5SequenceSet with specific HDF5 dataset assumed. Specifically,
     it assumes that properties such as `neurons` and `stats` are present in the dataset.
+    Further keyword arguments (e.g. `eager_keys`, `prefetch` or `swmr`) are passed on to H5SequenceSet.
     """
 
-    def __init__(self, filename, *data_groups, output_rename=None, transforms=None, stats_source="all"):
-        super().__init__(filename, *data_groups, output_rename=output_rename, transforms=transforms)
+    def __init__(self, filename, *data_groups, output_rename=None, transforms=None, stats_source="all", **kwargs):
+        super().__init__(filename, *data_groups, output_rename=output_rename, transforms=transforms, **kwargs)
         self.stats_source = stats_source
 
         # set to accept only MovieTransform
@@ -134,7 +389,7 @@ class MovieSet(H5SequenceSet):
         if stats_source is None:
             stats_source = self.stats_source
 
-        tmp = [np.atleast_1d(self.statistics[g][stats_source]["mean"][()]) for g in self.data_keys]
+        tmp = [np.atleast_1d(self._statistic(g, stats_source, "mean")) for g in self.data_keys]
         x = self.transform(self.data_point(*tmp), exclude=(Subsequence, Delay))
         if self.rename_output:
             x = self.output_point(*x)
@@ -143,16 +398,16 @@ class MovieSet(H5SequenceSet):
     def rf_base(self, stats_source="all"):
         N, c, t, w, h = self.img_shape
         t = min(t, 150)
-        mean = lambda dk: self.statistics[dk][stats_source]["mean"][()]
+        mean = lambda dk: self._statistic(dk, stats_source, "mean")
         d = dict(
-            inputs=np.ones((1, c, t, w, h)) * np.array(mean("inputs")),
-            eye_position=np.ones((1, t, 1)) * mean("eye_position")[None, None, :],
-            behavior=np.ones((1, t, 1)) * mean("behavior")[None, None, :],
-            responses=np.ones((1, t, 1)) * mean("responses")[None, None, :],
+            inputs=_filled((1, c, t, w, h), mean("inputs")),
+            eye_position=_tile_mean(mean("eye_position"), 1, t),
+            behavior=_tile_mean(mean("behavior"), 1, t),
+            responses=_tile_mean(mean("responses"), 1, t),
         )
         return self.transform(self.data_point(*[d[dk] for dk in self.data_keys]), exclude=Subsequence)
 
-    def rf_noise_stim(self, m, t, stats_source="all"):
+    def rf_noise_stim(self, m, t, stats_source="all", seed=None):
         """
         Generates a Gaussian white noise stimulus filtered with a 3x3 Gaussian filter
         for the computation of receptive fields. The mean and variance of the Gaussian
@@ -161,37 +416,40 @@ class MovieSet(H5SequenceSet):
         Args:
             m: number of noise samples
             t: length in time
+            seed: seed for the noise generator. Defaults to None, in which case fresh entropy is used.
         Returns: tuple of input, behavior, eye, and response
         """
+        from scipy.ndimage import convolve1d
+
         N, c, _, w, h = self.img_shape
-        stat = lambda dk, what: self.statistics[dk][stats_source][what][()]
+        stat = lambda dk, what: np.float32(self._statistic(dk, stats_source, what))
         mu, s = stat("inputs", "mean"), stat("inputs", "std")
-        h_filt = np.float64([[1 / 16, 1 / 8, 1 / 16], [1 / 8, 1 / 4, 1 / 8], [1 / 16, 1 / 8, 1 / 16]])
-        noise_input = (
-            np.stack([convolve2d(np.random.randn(w, h), h_filt, mode="same") for _ in range(m * t * c)]).reshape(
-                (m, c, t, w, h)
-            )
-            * s
-            + mu
-        )
-
-        mean_beh = np.ones((m, t, 1)) * stat("behavior", "mean")[None, None, :]
-        mean_eye = np.ones((m, t, 1)) * stat("eye_position", "mean")[None, None, :]
-        mean_resp = np.ones((m, t, 1)) * stat("responses", "mean")[None, None, :]
+        # the 3x3 Gaussian filter is separable, so filter all frames at once along each spatial axis
+        h_filt = np.float32([1 / 4, 1 / 2, 1 / 4])
+        rng = np.random.default_rng(seed)
+        noise_input = rng.standard_normal(size=(m * c * t, w, h), dtype=np.float32)
+        # the second pass writes back into the noise, so that only one extra array is needed
+        filtered = convolve1d(noise_input, h_filt, axis=1, mode="constant")
+        convolve1d(filtered, h_filt, axis=2, mode="constant", output=noise_input)
+        noise_input = noise_input.reshape((m, c, t, w, h))
+        np.multiply(noise_input, s, out=noise_input)
+        noise_input += mu
+
+        mean_beh = _tile_mean(stat("behavior", "mean"), m, t)
+        mean_eye = _tile_mean(stat("eye_position", "mean"), m, t)
+        mean_resp = _tile_mean(stat("responses", "mean"), m, t)
 
         d = dict(
-            inputs=noise_input.astype(np.float32),
-            eye_position=mean_eye.astype(np.float32),
-            behavior=mean_beh.astype(np.float32),
-            responses=mean_resp.astype(np.float32),
+            inputs=noise_input,
+            eye_position=mean_eye,
+            behavior=mean_beh,
+            responses=mean_resp,
         )
 
-        return self.transform(
-            self.data_point(*[d[dk] for dk in self.data_groups.values()]), exclude=(Subsequence, Delay)
-        )
+        return self.transform(self.data_point(*[d[dk] for dk in self.data_keys]), exclude=(Subsequence, Delay))
 
 
-class MovieFileTreeDataset(FileTreeDatasetBase):
+class MovieFileTreeDataset(_StatisticsCacheMixin, FileTreeDatasetBase):
     _transform_types = (MovieTransform,)
 
     def __init__(self, *args, stats_source=None, **kwargs):
@@ -229,7 +487,7 @@ class MovieFileTreeDataset(FileTreeDatasetBase):
         if stats_source is None:
             stats_source = self.stats_source
 
-        tmp = [np.atleast_1d(self.statistics[g][stats_source]["mean"][()]) for g in self.data_keys]
+        tmp = [np.atleast_1d(self._statistic(g, stats_source, "mean")) for g in self.data_keys]
         x = self.transform(self.data_point(*tmp), exclude=(Subsequence, Delay))
         if self.rename_output:
             x = self._output_point(*x)
@@ -241,6 +499,8 @@ class NRandomSubSequenceDataset(Dataset):
     Data augmentation for training.
     Generate a new dataset based on original_dat, by random sampling of each training item in original_dat for multiple times.
     This only works for movie data and each sampling is a subsequence of the full sequence in a original_dat item.
+    Batches from a DataLoader with the default collate_fn come out field-wise, i.e. as one data point whose fields
+    each hold a single tensor with the whole batch. See `worker_init_fn` for sampling with multiple workers.
     Args:
         original_dat: an original dataset
         num_random_subsequence: number of subsequences sampled from each original_dat item
@@ -257,42 +517,61 @@ class NRandomSubSequenceDataset(Dataset):
         sequence_length=300,
         seed=10,
     ):
-        new_tiers = []  # list, tiers for each item in new dataset
-        new_inds = []  # list, indice for each item in new dataset
-        for ii, tier in enumerate(original_dat.trial_info.tiers):
-            if tier != "none":  # if tier!='none' and ii<15:
-                # print (ii, dat2[ii]._fields, tier)
-                if tier == "train":
-                    new_tiers.extend(["train"] * num_random_subsequence)
-                    new_inds.extend([ii] * num_random_subsequence)
-                else:
-                    new_tiers.append(tier)
-                    new_inds.append(ii)
+        tiers = np.asarray(original_dat.trial_info.tiers)
+        inds = np.flatnonzero(tiers != "none")
+        # every training item is repeated num_random_subsequence times, all other items once
+        repeats = np.where(tiers[inds] == "train", num_random_subsequence, 1)
+        new_inds = np.repeat(inds, repeats)  # array, indice for each item in new dataset
+        new_tiers = np.repeat(tiers[inds], repeats)  # array, tiers for each item in new dataset
 
         self.original_dat = original_dat
         self.new_tiers = new_tiers
         self.new_inds = new_inds
-        np.random.seed(seed)
-        self.random_start = np.random.randint(
-            low=0, high=sequence_length - subsequence_length, size=num_random_subsequence
+        self.num4rand = num_random_subsequence
+        self.subsequence_length = subsequence_length
+        self.sequence_length = sequence_length
+        self.seed = seed
+        self._is_train = new_tiers == "train"
+        self.reseed(seed)
+
+    def reseed(self, seed):
+        """
+        Draws new start positions of the random subsequences from a generator seeded with `seed`,
+        leaving the global numpy random state untouched.
+        """
+        rng = np.random.default_rng(seed)
+        self.random_start = rng.integers(
+            0, self.sequence_length - self.subsequence_length, size=self.num4rand
         )  # array, start positions at each original_dat item for random sampling
-        self.num4rand = len(self.random_start)
-        self.random_end = self.random_start + subsequence_length
+        self.random_end = self.random_start + self.subsequence_length
+
+        # look up table of the subsequence boundaries for each item in new dataset (0, 0 for non-training items)
+        k = np.arange(len(self.new_inds)) % self.num4rand
+        self._starts = np.where(self._is_train, self.random_start[k], 0)
+        self._ends = np.where(self._is_train, self.random_end[k], 0)
+
+    def _subsequence(self, x, index):
+        window = slice(self._starts[index], self._ends[index])
+        return x._make(v[:, window] for v in x)
 
     def __getitem__(self, index):
-        if self.new_tiers[index] == "train":
-            return self.original_dat[self.new_inds[index]].__class__(
-                **{
-                    k: getattr(self.original_dat[self.new_inds[index]], k)[
-                        :,
-                        self.random_start[index % self.num4rand] : self.random_end[index % self.num4rand],
-                    ]
-                    for k in self.original_dat[self.new_inds[index]]._fields
-                }
-            )
+        x = self.original_dat[self.new_inds[index]]
+        if self._is_train[index]:
+            return self._subsequence(x, index)
+        return x
 
-        else:
-            return self.original_dat[self.new_inds[index]]
+    def __getitems__(self, indices):
+        # used by the DataLoader for whole batches: every original item is only loaded once,
+        # no matter how many of its subsequences end up in the batch
+        items = {}
+        samples = []
+        for index in indices:
+            ind = self.new_inds[index]
+            if ind not in items:
+                items[ind] = self.original_dat[ind]
+            x = items[ind]
+            samples.append(self._subsequence(x, index) if self._is_train[index] else x)
+        return samples
 
     def __len__(self):
         return len(self.new_tiers)
@@ -300,3 +579,19 @@ class NRandomSubSequenceDataset(Dataset):
     @property
     def neurons(self):
         return self.original_dat.neurons
+
+
+def worker_init_fn(worker_id):
+    """
+    Prepares the dataset of a DataLoader worker: a NRandomSubSequenceDataset is reseeded with its seed offset
+    by `worker_id`, so that the workers sample different, but reproducible subsequences, and an underlying
+    H5SequenceSet opens its own file handle. A dataset without seed is reseeded with the seed the DataLoader
+    chose for the worker. Pass as `worker_init_fn` to the DataLoader.
+    """
+    worker_info = torch.utils.data.get_worker_info()
+    dataset = worker_info.dataset
+    if isinstance(dataset, NRandomSubSequenceDataset):
+        dataset.reseed(worker_info.seed if dataset.seed is None else dataset.seed + worker_id)
+        dataset = dataset.original_dat
+    if isinstance(dataset, H5SequenceSet):
+        dataset._ensure_fid()
@@ -1,7 +1,5 @@
 from collections import namedtuple
 
-import h5py
-
 from ...transforms import StaticTransform
 from ...utils import recursively_load_dict_contents_from_group
 from ..base import TransformDataset, default_image_datapoint
@@ -34,6 +32,8 @@ class H5ArraySet(StaticSet):
         """
         super().__init__(*data_keys, transforms=transforms)
 
+        import h5py
+
         self._fid = h5py.File(filename, "r")
         self.data = self._fid
         self.data_loaded = False
@@ -75,6 +75,8 @@ class H5ArraySet(StaticSet):
 
     def __getattr__(self, item):
         if item in self.data:
+            import h5py
+
             item = self.data[item]
             if isinstance(item, h5py.Dataset):
                 dtype = item.dtype
@@ -9,7 +9,6 @@ except:
 
 import numpy as np
 import torch
-from skimage.transform import rescale
 
 
 def transform_function(img, behavior, key):
@@ -287,11 +286,13 @@ class ToTensor(MovieTransform, StaticTransform, Invertible):
         return y.numpy()
 
     def __call__(self, x):
+        # only copies if elem is not already a writable, contiguous float32 array that owns its memory,
+        # so that tensors never share memory with (views into) data still held by the dataset
         return x.__class__(
             *[
-                torch.from_numpy(elem.astype(np.float32))
+                torch.from_numpy(np.require(elem, np.float32, ("C", "W", "O")))
                 if not self.cuda
-                else torch.from_numpy(elem.astype(np.float32)).cuda()
+                else torch.from_numpy(np.require(elem, np.float32, ("C", "W", "O"))).cuda()
                 for elem in x
             ]
         )
@@ -576,6 +577,10 @@ class ScaleInputs(StaticTransform, Invertible, MovieTransform):
         in_name="images",
         channel_axis=0,
     ):
+        # skimage is only imported once a transform needs it, not with this module
+        from skimage.transform import rescale
+
+        self._rescale = rescale
         self.scale = scale
         self.mode = mode
         self.anti_aliasing = anti_aliasing
@@ -587,7 +592,7 @@ class ScaleInputs(StaticTransform, Invertible, MovieTransform):
     def __call__(self, x):
         key_vals = {k: v for k, v in zip(x._fields, x)}
         img = key_vals[self.in_name]
-        key_vals[self.in_name] = rescale(
+        key_vals[self.in_name] = self._rescale(
             img,
             scale=self.scale,
             mode=self.mode,
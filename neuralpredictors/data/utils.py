@@ -7,7 +7,6 @@ except:
 from pathlib import Path
 from zipfile import ZIP_DEFLATED, ZipFile
 
-import h5py
 import numpy as np
 from tqdm import tqdm
 
@@ -49,6 +48,8 @@ def convert_movies_h5_dataset_to_folder(
         outpath:        location of the FileTreeDataset (default .)
         overwrite:      overwrite existing files
     """
+    import h5py
+
     if not isinstance(data_keys, Mapping):
         data_keys = {k: k for k in data_keys}
 
@@ -115,6 +116,53 @@ def convert_movies_h5_dataset_to_folder(
         fid["statistics"].visititems(statistics_func)
 
 
+def convert_movies_h5_dataset_to_stacked(
+    filename,
+    outfile,
+    data_keys=("inputs", "responses", "behavior", "eye_position"),
+    compression="lzf",
+):
+    """
+    Converts an HDF5 dataset used for mouse movie data, where each trial of a data key is a separate dataset
+    "0", "1", ... within a group, into an HDF5 file where each data key is a single chunked dataset with the
+    trials stacked along the first axis. H5SequenceSet reads the latter through one dataset handle per key
+    instead of looking up every trial in the group. Data keys without trials or whose trials differ in shape
+    cannot be stacked and are copied unchanged, as is all other content of the file.
+
+    Args:
+        filename:       filename of the hdf5 file
+        outfile:        filename of the converted hdf5 file
+        data_keys:      data keys to be stacked
+        compression:    compression of the stacked datasets (default "lzf", which is fast to decompress)
+    """
+    import h5py
+
+    with h5py.File(filename, "r") as fid, h5py.File(outfile, "w") as out:
+        out.attrs.update(fid.attrs)
+        for key, item in fid.items():
+            if key not in data_keys or not isinstance(item, h5py.Group):
+                fid.copy(item, out, name=key)
+                continue
+
+            trials = [item[str(i)] for i in range(len(item))]
+            if len({trial.shape for trial in trials}) != 1:
+                logger.warning("Trials of {} are missing or differ in shape, copying without stacking".format(key))
+                fid.copy(item, out, name=key)
+                continue
+
+            shape = trials[0].shape
+            stacked = out.create_dataset(
+                key,
+                shape=(len(trials),) + shape,
+                dtype=trials[0].dtype,
+                chunks=(1,) + shape,
+                compression=compression,
+            )
+            stacked.attrs.update(item.attrs)
+            for i, trial in enumerate(tqdm(trials, desc="Stacking {}".format(key))):
+                stacked[i] = trial[()]
+
+
 def convert_static_h5_dataset_to_folder(filename, outpath=None, overwrite=False, ignore_all_behaviors=False):
     """
     Converts a h5 dataset used for mouse data into a directory structure that can be used by the FileTreeDataset.
@@ -125,6 +173,8 @@ def convert_static_h5_dataset_to_folder(filename, outpath=None, overwrite=False,
         overwrite:      overwrite existing files
 
     """
+    import h5py
+
     h5file = Path(filename)
     outpath = outpath or (h5file.parent / h5file.stem)
 
@@ -189,6 +239,8 @@ def load_dict_from_hdf5(filename):
     Returns:
         (nested) dictionary corresponding to the content of the HDF5 file.
     """
+    import h5py
+
     with h5py.File(filename, "r") as h5file:
         return recursively_load_dict_contents_from_group(h5file)
 
@@ -205,6 +257,8 @@ def recursively_load_dict_contents_from_group(h5file, path="/"):
     Returns:
         (nested) dictionary corresponding to the content of the HDF5 file at the path.
     """
+    import h5py
+
     ans = {}
     for key, item in h5file[path].items():
         if isinstance(item, h5py.Dataset):
@@ -0,0 +1,385 @@
+import gc
+import pickle
+from collections import namedtuple
+from types import SimpleNamespace
+
+import h5py
+import numpy as np
+import pytest
+import torch
+from scipy.signal import convolve2d
+from torch.utils.data import DataLoader
+
+from neuralpredictors.data.datasets.movies import (
+    H5SequenceSet,
+    MovieFileTreeDataset,
+    MovieSet,
+    NRandomSubSequenceDataset,
+    _point_class,
+    worker_init_fn,
+)
+from neuralpredictors.data.transforms import ToTensor
+from neuralpredictors.data.utils import (
+    convert_movies_h5_dataset_to_stacked,
+    recursively_load_dict_contents_from_group,
+)
+
+DataPoint = namedtuple("DataPoint", ("inputs", "responses"))
+data_keys = ("inputs", "responses", "behavior", "eye_position")
+n_trials, channels, frames, width, height, n_neurons = 6, 1, 20, 4, 5, 3
+
+
+def write_movie_file(filename, inputs_mean=0.5, inputs_std=0.2):
+    """Writes a small movie file with one dataset per trial in each data key."""
+    rng = np.random.default_rng(0)
+    shapes = dict(
+        inputs=(channels, frames, width, height),
+        responses=(n_neurons, frames),
+        behavior=(3, frames),
+        eye_position=(2, frames),
+    )
+    with h5py.File(filename, "w") as fid:
+        for key, shape in shapes.items():
+            group = fid.create_group(key)
+            group.attrs["_iterable"] = True
+            for i in range(n_trials):
+                group[str(i)] = rng.random(shape, dtype=np.float32)
+            for stats_source in ("all", "stimulus_frame"):
+                stats = fid.create_group("statistics/{}/{}".format(key, stats_source))
+                stats["mean"] = inputs_mean if key == "inputs" else rng.random(shape[0])
+                stats["std"] = inputs_std if key == "inputs" else rng.random(shape[0]) + 0.5
+        fid["tiers"] = np.array([b"train"] * 3 + [b"validation", b"test", b"none"])
+        fid["img_shape"] = np.array([n_trials, channels, frames, width, height])
+        fid["neurons/unit_ids"] = np.arange(n_neurons)
+    return filename
+
+
+@pytest.fixture
+def movie_file(tmp_path):
+    return write_movie_file(tmp_path / "movies.h5")
+
+
+@pytest.fixture
+def stacked_file(movie_file, tmp_path):
+    convert_movies_h5_dataset_to_stacked(movie_file, tmp_path / "stacked.h5")
+    return tmp_path / "stacked.h5"
+
+
+def assert_contents_equal(a, b):
+    if isinstance(b, dict):
+        assert a.keys() == b.keys()
+        for key in b:
+            assert_contents_equal(a[key], b[key])
+    else:
+        assert np.array_equal(a, b)
+
+
+def assert_items_equal(a, b):
+    assert type(a) is type(b)
+    assert all(np.array_equal(u, v) for u, v in zip(a, b))
+
+
+class TestPointClass:
+    def test_to_keeps_class(self):
+        point = _point_class("DataPoint", ("inputs", "responses"))(torch.ones(2, 3), torch.zeros(4))
+        moved = point.to("cpu")
+        assert type(moved) is type(point)
+        assert_items_equal(pickle.loads(pickle.dumps(moved)), moved)
+
+    def test_same_fields_give_same_class(self):
+        assert _point_class("DataPoint", ("inputs",)) is _point_class("DataPoint", ("inputs",))
+
+    @pytest.mark.skipif(not torch.cuda.is_available(), reason="pinned memory requires CUDA")
+    def test_pin_memory_keeps_class(self):
+        point = _point_class("DataPoint", ("inputs", "responses"))(torch.ones(2, 3), np.zeros(4, dtype=np.float32))
+        pinned = point.pin_memory()
+        assert type(pinned) is type(point)
+        assert all(v.is_pinned() for v in pinned)
+        assert_items_equal(pickle.loads(pickle.dumps(pinned)), pinned)
+
+
+class SequenceDataset:
+    """Minimal stand-in for a movie dataset with trials of the given tiers."""
+
+    def __init__(self, tiers, sequence_length=30):
+        self.trial_info = SimpleNamespace(tiers=np.array(tiers))
+        self.sequence_length = sequence_length
+
+    def __getitem__(self, item):
+        t = np.arange(self.sequence_length, dtype=np.float32)
+        return DataPoint(inputs=np.stack([t, -t]) + 100 * item, responses=np.stack([t, t, t]) + 100 * item)
+
+    def __len__(self):
+        return len(self.trial_info.tiers)
+
+
+tiers = ["train", "none", "validation", "train", "test", "none", "train"]
+
+
+def loop_indices(tiers, num_random_subsequence):
+    # reference implementation of the new dataset's items as one loop over the original tiers
+    new_tiers, new_inds = [], []
+    for ii, tier in enumerate(tiers):
+        if tier != "none":
+            if tier == "train":
+                new_tiers.extend(["train"] * num_random_subsequence)
+                new_inds.extend([ii] * num_random_subsequence)
+            else:
+                new_tiers.append(tier)
+                new_inds.append(ii)
+    return new_tiers, new_inds
+
+
+class TestNRandomSubSequenceDataset:
+    @pytest.mark.parametrize("num_random_subsequence", [1, 4])
+    def test_indices_match_loop(self, num_random_subsequence):
+        dat = NRandomSubSequenceDataset(
+            SequenceDataset(tiers),
+            num_random_subsequence=num_random_subsequence,
+            subsequence_length=10,
+            sequence_length=30,
+        )
+        new_tiers, new_inds = loop_indices(tiers, num_random_subsequence)
+
+        assert len(dat) == len(new_tiers)
+        assert list(dat.new_tiers) == new_tiers
+        assert list(dat.new_inds) == new_inds
+        assert np.issubdtype(dat.new_inds.dtype, np.integer)
+
+    def test_subsequence_bounds_match_loop(self):
+        dat = NRandomSubSequenceDataset(
+            SequenceDataset(tiers), num_random_subsequence=4, subsequence_length=10, sequence_length=30
+        )
+        for index, tier in enumerate(dat.new_tiers):
+            if tier == "train":
+                assert dat._starts[index] == dat.random_start[index % dat.num4rand]
+                assert dat._ends[index] == dat.random_end[index % dat.num4rand]
+                assert dat._ends[index] - dat._starts[index] == 10
+
+    def test_items_match_loop(self):
+        original = SequenceDataset(tiers)
+        dat = NRandomSubSequenceDataset(original, num_random_subsequence=4, subsequence_length=10, sequence_length=30)
+        for index in range(len(dat)):
+            x = original[dat.new_inds[index]]
+            if dat.new_tiers[index] == "train":
+                start, end = dat.random_start[index % dat.num4rand], dat.random_end[index % dat.num4rand]
+                x = x.__class__(**{k: getattr(x, k)[:, start:end] for k in x._fields})
+            item = dat[index]
+            assert type(item) is type(x)
+            assert all(np.array_equal(a, b) for a, b in zip(item, x))
+
+    def test_getitems_matches_getitem(self):
+        dat = NRandomSubSequenceDataset(
+            SequenceDataset(tiers), num_random_subsequence=4, subsequence_length=10, sequence_length=30
+        )
+        indices = [5, 0, 1, len(dat) - 1, 0, 8]
+        for item, index in zip(dat.__getitems__(indices), indices):
+            assert all(np.array_equal(a, b) for a, b in zip(item, dat[index]))
+
+    @pytest.mark.parametrize("seed", [None, 3])
+    def test_worker_init_fn(self, seed):
+        dat = NRandomSubSequenceDataset(
+            SequenceDataset(["train"] * 3),
+            num_random_subsequence=4,
+            subsequence_length=10,
+            sequence_length=30,
+            seed=seed,
+        )
+        loader = DataLoader(dat, batch_size=4, num_workers=2, worker_init_fn=worker_init_fn)
+        assert sum(len(batch.inputs) for batch in loader) == len(dat)
+
+    def test_seed_is_reproducible(self):
+        kwargs = dict(num_random_subsequence=4, subsequence_length=10, sequence_length=30, seed=3)
+        a = NRandomSubSequenceDataset(SequenceDataset(tiers), **kwargs)
+        b = NRandomSubSequenceDataset(SequenceDataset(tiers), **kwargs)
+        assert np.array_equal(a.random_start, b.random_start)
+        assert np.array_equal(a._starts, b._starts)
+
+
+class TestStackedConversion:
+    def test_data_keys_are_stacked(self, movie_file, stacked_file):
+        with h5py.File(movie_file, "r") as fid, h5py.File(stacked_file, "r") as out:
+            for key in data_keys:
+                assert isinstance(out[key], h5py.Dataset)
+                assert len(out[key]) == n_trials
+                for i in range(n_trials):
+                    assert np.array_equal(out[key][i], fid[key][str(i)][()])
+                assert dict(out[key].attrs) == dict(fid[key].attrs)
+
+    def test_other_content_is_copied(self, movie_file, stacked_file):
+        with h5py.File(movie_file, "r") as fid, h5py.File(stacked_file, "r") as out:
+            for key in ("tiers", "img_shape", "statistics", "neurons"):
+                assert_contents_equal(
+                    recursively_load_dict_contents_from_group(out)[key],
+                    recursively_load_dict_contents_from_group(fid)[key],
+                )
+
+    def test_empty_and_ragged_groups_are_copied(self, tmp_path):
+        with h5py.File(tmp_path / "movies.h5", "w") as fid:
+            fid.create_group("empty")
+            fid["ragged/0"] = np.zeros((2, 3))
+            fid["ragged/1"] = np.zeros((2, 4))
+        convert_movies_h5_dataset_to_stacked(
+            tmp_path / "movies.h5", tmp_path / "stacked.h5", data_keys=("empty", "ragged")
+        )
+        with h5py.File(tmp_path / "stacked.h5", "r") as out:
+            assert isinstance(out["empty"], h5py.Group) and len(out["empty"]) == 0
+            assert isinstance(out["ragged"], h5py.Group) and out["ragged/1"].shape == (2, 4)
+
+
+class TestH5SequenceSet:
+    @pytest.mark.parametrize("eager_keys", [(), ("responses", "behavior")])
+    @pytest.mark.parametrize("prefetch", [0, 1, 4])
+    @pytest.mark.parametrize("stacked", [False, True])
+    def test_reads_match_lazy_group_reads(self, movie_file, stacked_file, stacked, prefetch, eager_keys):
+        reference = H5SequenceSet(movie_file, *data_keys, eager_keys=())
+        dat = H5SequenceSet(
+            stacked_file if stacked else movie_file, *data_keys, prefetch=prefetch, eager_keys=eager_keys
+        )
+        assert len(dat) == len(reference)
+        for i in [0, 1, 5, 2, 4, 3, 0]:
+            assert_items_equal(dat[i], reference[i])
+
+    def test_loaded_content_matches_file(self, movie_file):
+        dat = H5SequenceSet(movie_file, *data_keys, eager_keys=())
+        expected = [dat[i] for i in range(len(dat))]
+        dat.load_content()
+        for i in range(len(dat)):
+            assert_items_equal(dat[i], expected[i])
+
+    def test_eager_keys_are_held_in_memory(self, movie_file):
+        assert not H5SequenceSet(movie_file, *data_keys, eager_keys=())._eager
+        assert set(H5SequenceSet(movie_file, *data_keys)._eager) == {"responses", "behavior", "eye_position"}
+
+    @pytest.mark.parametrize("load_content", [False, True])
+    def test_pickle(self, movie_file, load_content):
+        dat = MovieSet(movie_file, *data_keys, output_rename={"inputs": "videos"})
+        if load_content:
+            dat.load_content()
+        unpickled = pickle.loads(pickle.dumps(dat))
+        assert np.array_equal(unpickled.tiers, dat.tiers)
+        assert unpickled.n_neurons == n_neurons
+        for i in range(len(dat)):
+            assert_items_equal(unpickled[i], dat[i])
+
+    def test_spawned_workers(self, movie_file):
+        dat = H5SequenceSet(movie_file, *data_keys)
+        loader = DataLoader(dat, batch_size=2, num_workers=1, multiprocessing_context="spawn")
+        batches = list(loader)
+        assert sum(len(batch.inputs) for batch in batches) == len(dat)
+        assert np.array_equal(batches[0].responses[1], dat[1].responses)
+
+    @pytest.mark.parametrize("toggle", [False, True])
+    @pytest.mark.parametrize("output_dict", [False, True])
+    @pytest.mark.parametrize("rename_output", [False, True])
+    def test_output_flags(self, movie_file, rename_output, output_dict, toggle):
+        if toggle:
+            # flags changed after construction are followed as well
+            dat = H5SequenceSet(movie_file, *data_keys, output_rename={"inputs": "videos"}, output_dict=not output_dict)
+            dat.rename_output = not rename_output
+            assert isinstance(dat[0], dict) is not output_dict
+            dat.rename_output, dat.output_dict = rename_output, output_dict
+        else:
+            dat = H5SequenceSet(movie_file, *data_keys, output_rename={"inputs": "videos"}, output_dict=output_dict)
+            dat.rename_output = rename_output
+
+        item = dat[0]
+        keys = ("videos",) + data_keys[1:] if rename_output else data_keys
+        if output_dict:
+            assert isinstance(item, dict)
+            assert tuple(item) == keys
+        else:
+            assert type(item).__name__ == ("OutputPoint" if rename_output else "DataPoint")
+            assert item._fields == keys
+        values = item.values() if output_dict else item
+        assert all(np.array_equal(u, v) for u, v in zip(values, H5SequenceSet(movie_file, *data_keys)[0]))
+
+    def test_prefetched_items_are_copies(self, stacked_file):
+        dat = H5SequenceSet(stacked_file, *data_keys, prefetch=4, eager_keys=())
+        expected = dat[1].inputs.copy()
+        dat[1].inputs[...] = 0
+        assert np.array_equal(dat[1].inputs, expected)
+
+
+class TestMovieSet:
+    @pytest.mark.parametrize("inputs_mean", [0.5, np.full(1, 0.5), np.full((width, height), 0.5)])
+    def test_rf_base_shape(self, tmp_path, inputs_mean):
+        dat = MovieSet(write_movie_file(tmp_path / "movies.h5", inputs_mean=inputs_mean), *data_keys)
+        base = dat.rf_base()
+        assert base.inputs.shape == (1, channels, frames, width, height)
+        assert np.allclose(base.inputs, 0.5)
+        assert base.responses.shape == (1, frames, n_neurons)
+
+    @pytest.mark.parametrize("eager_keys", [(), ("responses",)])
+    @pytest.mark.parametrize("load_content", [False, True])
+    def test_tensors_do_not_share_memory_with_dataset(self, movie_file, eager_keys, load_content):
+        dat = MovieSet(movie_file, *data_keys, transforms=[ToTensor()], eager_keys=eager_keys)
+        if load_content:
+            dat.load_content()
+        expected = dat[0].responses.clone()
+        dat[0].responses.mul_(0)
+        assert (dat[0].responses == expected).all()
+
+    def test_attributes_outlive_dataset(self, movie_file):
+        neurons = MovieSet(movie_file, *data_keys).neurons
+        gc.collect()
+        assert np.array_equal(neurons.unit_ids, np.arange(n_neurons))
+
+    def test_transformed_mean_does_not_share_memory_with_statistics(self, movie_file):
+        with h5py.File(movie_file, "a") as fid:
+            mean = fid["statistics/responses/all/mean"][()].astype(np.float32)
+            del fid["statistics/responses/all/mean"]
+            fid["statistics/responses/all/mean"] = mean
+        dat = MovieSet(movie_file, *data_keys, transforms=[ToTensor()])
+        dat.transformed_mean().responses.mul_(0)
+        assert np.array_equal(dat.transformed_mean().responses, mean)
+        assert np.array_equal(dat._statistic("responses", "all", "mean"), mean)
+
+    @pytest.mark.parametrize(
+        "inputs_mean,inputs_std",
+        [
+            (0.5, 0.2),
+            (
+                np.arange(width * height).reshape(width, height) / 10,
+                np.arange(width * height).reshape(width, height) + 1,
+            ),
+        ],
+    )
+    def test_rf_noise_stim_matches_filtered_noise(self, tmp_path, inputs_mean, inputs_std):
+        filename = write_movie_file(tmp_path / "movies.h5", inputs_mean=inputs_mean, inputs_std=inputs_std)
+        dat = MovieSet(filename, *data_keys)
+        m, t = 2, 7
+        stim = dat.rf_noise_stim(m, t, seed=1)
+
+        # reference: every frame of the same draws filtered with the full 3x3 filter
+        noise = np.random.default_rng(1).standard_normal(size=(m * channels * t, width, height), dtype=np.float32)
+        h_filt = np.outer([1 / 4, 1 / 2, 1 / 4], [1 / 4, 1 / 2, 1 / 4])
+        filtered = np.stack([convolve2d(frame, h_filt, mode="same") for frame in noise])
+        expected = filtered.reshape(m, channels, t, width, height) * inputs_std + inputs_mean
+        assert np.allclose(stim.inputs, expected, atol=1e-5)
+
+        assert stim.inputs.shape == (m, channels, t, width, height)
+        assert stim.behavior.shape == (m, t, 3)
+        assert stim.eye_position.shape == (m, t, 2)
+        assert stim.responses.shape == (m, t, n_neurons)
+        assert all(v.dtype == np.float32 for v in stim)
+
+    def test_rf_noise_stim_seed(self, movie_file):
+        dat = MovieSet(movie_file, *data_keys)
+        assert_items_equal(dat.rf_noise_stim(2, 5, seed=3), dat.rf_noise_stim(2, 5, seed=3))
+        assert not np.array_equal(dat.rf_noise_stim(2, 5, seed=3).inputs, dat.rf_noise_stim(2, 5, seed=4).inputs)
+
+
+def test_file_tree_tensors_do_not_share_memory_with_cache(tmp_path):
+    rng = np.random.default_rng(0)
+    for key in ("inputs", "responses"):
+        (tmp_path / "data" / key).mkdir(parents=True)
+        for i in range(n_trials):
+            np.save(tmp_path / "data" / key / "{}.npy".format(i), rng.random((3, frames), dtype=np.float32))
+    (tmp_path / "meta" / "trials").mkdir(parents=True)
+    np.save(tmp_path / "meta" / "trials" / "tiers.npy", np.array(["train"] * n_trials))
+
+    dat = MovieFileTreeDataset(str(tmp_path), "inputs", "responses", transforms=[ToTensor()], use_cache=True)
+    expected = dat[0].responses.clone()
+    dat[0].responses.mul_(0)
+    assert (dat[0].responses == expected).all()